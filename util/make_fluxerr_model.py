@@ -17,10 +17,35 @@
 #
 # ========================
 
-import os, sys, argparse, glob, yaml, math
+import os, sys, argparse, glob, yaml, math, pickle, hashlib
+import gzip, shutil, subprocess
 import numpy as np
 from   argparse import Namespace
 import pandas as pd
+from   concurrent.futures import ThreadPoolExecutor
+
+# optional: numba compiles the per-bin map statistics into a parallel
+# loop; without numba the same statistics are computed with numpy.
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+# use libyaml C loader when available (much faster for large SNANA
+# YAML outputs); else pure-python loader.
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader  as YamlLoader
+
+# optional: pyarrow enables parquet copy of each OUTLIER table so that
+# reruns of map stage skip the slow TEXT parse.
+try:
+    import pyarrow.parquet
+    HAS_PYARROW = True
+except ImportError:
+    HAS_PYARROW = False
 
 #JOBNAME_SNANA = "/home/rkessler/SNANA/bin/snana.exe"
 JOBNAME_SNANA = "snana.exe"
@@ -42,12 +67,25 @@ HOSTNAME      = os.uname()[1].split('.')[0]
 COLNAME_BIN1D    = "BIN1D"
 COLNAME_IFILTOBS = "IFILTOBS"
 COLNAME_BAND     = "BAND"
+COLNAME_FIELD    = "FIELD"
 COLNAME_IFIELD   = "IFIELD"
 
 IFILTOBS_MAX = 80
 
+NOBS_MIN_BIN = 5   # need more than this many obs per bin to compute ERRSCALE
+
 ISTAGE_MAKEMAP = 4
 
+MAP_BIN_CACHE_FILE     = ".fluxerr_map_bins.pkl"  # parsed map bins, under OUTDIR
+SURVEY_INFO_CACHE_FILE = ".survey_info.yaml"      # SURVEY & FILTERS, under OUTDIR
+
+GZIP_LEVEL   = 1         # fast compression for OUTLIER TEXT tables
+GZIP_BUFSIZE = 1 << 22   # 4 MB read chunks when compressing
+LOG_BUFSIZE  = 1 << 20   # 1 MB write buffer for streamed job logs
+PIPE_CHUNKSIZE = 1 << 16 # max bytes per read of streamed job output
+MAP_BUFSIZE  = 1 << 20   # 1 MB write buffer for FLUXERRMODEL map files
+MAP_NROW_WRITE = 4096    # write map rows to file in chunks of this many rows
+
 HELP_CONFIG = """
 # keys for input config file
 
@@ -114,6 +152,9 @@ def get_args():
     msg = "verify maps"
     parser.add_argument("--verify", help=msg, action="store_true")
 
+    msg = "number of independent snana jobs (FAKE, SIM) to run in parallel"
+    parser.add_argument("--nproc", help=msg, type=int, default=1)
+
     args = parser.parse_args()
 
     if args.makemap : args.start_stage = ISTAGE_MAKEMAP
@@ -127,12 +168,8 @@ def get_args():
     # end get_args
 
 def read_yaml(input_file):
-    input_lines = []
     with open(input_file, 'r') as f :
-        for line in f:
-            input_lines.append(line)
-
-    config_yaml = yaml.safe_load("\n".join(input_lines))
+        config_yaml = yaml.load(f, Loader=YamlLoader)
     return config_yaml
     # end read_yaml
 
@@ -158,9 +195,17 @@ def read_input(input_file):
             FIELD_GROUP_LISTS.append(field_list)
             #print(f" xxx field group {field_group_name} = {field_list}")
 
-    input_yaml['NFIELD_GROUP']      = len(FIELD_GROUP_NAMES)
-    input_yaml['FIELD_GROUP_NAMES'] = FIELD_GROUP_NAMES
-    input_yaml['FIELD_GROUP_LISTS'] = FIELD_GROUP_LISTS
+    # lookup {FIELD: group index} used to assign IFIELD to each obs.
+    # If a FIELD appears in more than one group, first group is used.
+    FIELD_GROUP_LOOKUP = {}
+    for ifield, field_list in enumerate(FIELD_GROUP_LISTS):
+        for FIELD in field_list:
+            FIELD_GROUP_LOOKUP.setdefault(FIELD, ifield)
+
+    input_yaml['NFIELD_GROUP']       = len(FIELD_GROUP_NAMES)
+    input_yaml['FIELD_GROUP_NAMES']  = FIELD_GROUP_NAMES
+    input_yaml['FIELD_GROUP_LISTS']  = FIELD_GROUP_LISTS
+    input_yaml['FIELD_GROUP_LOOKUP'] = FIELD_GROUP_LOOKUP
 
     return input_yaml
     # end read_input
@@ -187,8 +232,10 @@ def prep_outdir(config):
     if os.path.exists(OUTDIR) :
         if args.clobber : 
             do_mkdir = True
-            cmd = f"rm -r {OUTDIR}"
-            os.system(cmd)
+            try:
+                shutil.rmtree(OUTDIR)
+            except OSError as e:
+                sys.exit(f"\n ERROR: cannot remove OUTDIR {OUTDIR}: {e}\n")
     else :
         do_mkdir = True
 
@@ -204,8 +251,23 @@ def prep_outdir(config):
 def get_survey_info(config):
 
     # run snana.
+    # Result is saved in OUTDIR so that reruns (e.g., -s or --makemap)
+    # skip this snana job; saved result is ignored if older than input
+    # file, or if it was made from another data version.
+    OUTDIR            = config.input_yaml['OUTDIR']
     VERSION           = config.input_yaml['VERSION']
     PRIVATE_DATA_PATH = config.input_yaml['PRIVATE_DATA_PATH']
+    cache_file        = f"{OUTDIR}/{SURVEY_INFO_CACHE_FILE}"
+    cache_key         = f"{PRIVATE_DATA_PATH}/{VERSION}"
+
+    if os.path.exists(cache_file) and \
+       os.path.getmtime(cache_file) > os.path.getmtime(config.args.input_file):
+        cache = read_yaml(cache_file)
+        if cache['VERSION_FAKES'] == cache_key :
+            survey, filters = cache['SURVEY'], cache['FILTERS']
+            print(f" Read SURVEY-FILTER info from {cache_file} :")
+            print(f"\t -> Found SURVEY-FILTERS = {survey}-{filters} ")
+            return survey, filters
 
     TEXTFILE_PREFIX   = "TEMP_GET_SURVEY" # prefix for YAML output
     yaml_file         = f"{TEXTFILE_PREFIX}.YAML"
@@ -217,17 +279,21 @@ def get_survey_info(config):
           f"VERSION_PHOTOMETRY {VERSION} " \
           f"PRIVATE_DATA_PATH {PRIVATE_DATA_PATH} " \
           f"TEXTFILE_PREFIX {TEXTFILE_PREFIX} " \
-          f"MXEVT_PROCESS 0 OPT_YAML 1 > {log_file} "
+          f"MXEVT_PROCESS 0 OPT_YAML 1 "
 
-    os.system(cmd)
+    run_job(cmd.split(), log_file)
 
     snana_yaml = read_yaml(yaml_file)
     survey  = snana_yaml['SURVEY']
     filters = snana_yaml['FILTERS']
     print(f"\t -> Found SURVEY-FILTERS = {survey}-{filters} ")
 
-    cmd_rm = f"rm {yaml_file} {log_file}"
-    os.system(cmd_rm)
+    os.remove(yaml_file)
+    os.remove(log_file)
+
+    cache = { 'VERSION_FAKES': cache_key, 'SURVEY': survey, 'FILTERS': filters }
+    with open(cache_file,'wt') as f:
+        yaml.safe_dump(cache, f)
 
     return survey, filters
 
@@ -309,14 +375,79 @@ def run_snana_job(config, nml_prefix, nml_lines):
     sys.stdout.flush()
 
     # run it ...
-    cmd = f"cd {OUTDIR}; {JOBNAME_SNANA} {nml_file} > {log_file} "
-    os.system(cmd)
-
+    run_job([JOBNAME_SNANA, nml_file], log_file, cwd=OUTDIR)
 
     # end run_snana_job
 
+def run_job(cmd_list, log_file, cwd=None, stop_string=None):
+
+    # run external program cmd_list (no shell) with stdout+stderr
+    # written to log_file; log_file is relative to cwd, same as the
+    # previous shell "cd {cwd}; {cmd} > {log_file}".
+    # By default the program writes directly to log_file.
+    # If stop_string (bytes) is given, output is streamed through a pipe
+    # and searched as it arrives, and written to log_file through a 
+    # large buffer; at first stop_string the job is killed and function 
+    # returns True. Otherwise returns False.
+    # Exit status is not checked here; callers check log files.
+
+    if cwd is not None : log_file = f"{cwd}/{log_file}"
+
+    found_stop = False
+    try:
+        f_log = open(log_file, "wb", buffering=LOG_BUFSIZE)
+    except OSError as e:
+        sys.exit(f"\n ERROR: cannot write log file {log_file}: {e} \n")
+
+    # only the launch is caught here; message names the missing path
+    msg_err = f"\n ERROR: cannot run {cmd_list[0]} (cwd={cwd})"
+
+    with f_log:
+        if stop_string is None :
+            try:
+                subprocess.run(cmd_list, cwd=cwd,
+                               stdout=f_log, stderr=subprocess.STDOUT)
+            except FileNotFoundError as e:
+                sys.exit(f"{msg_err}: cannot find {e.filename} \n")
+            return found_stop
+
+        try:
+            proc = subprocess.Popen(cmd_list, cwd=cwd, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except FileNotFoundError as e:
+            sys.exit(f"{msg_err}: cannot find {e.filename} \n")
+
+        with proc:
+            # keep last len(stop_string)-1 bytes of output read so
+            # far, in case stop_string is split over several chunks.
+            ntail = len(stop_string) - 1
+            tail  = b''
+            while True:
+                chunk = proc.stdout.read1(PIPE_CHUNKSIZE)
+                if not chunk : break
+                f_log.write(chunk)
+                if stop_string in tail + chunk :
+                    found_stop = True
+                    proc.kill()
+                    break
+                tail = (tail + chunk)[-ntail:] if ntail > 0 else b''
+
+    return found_stop
+
+    # end run_job
+
 def simgen(ISTAGE,config):
 
+    # load name of GENVERSION here before ISTAGE check
+    prefix         = stage_prefix(ISTAGE)
+    GENVERSION     = f"{prefix}_simgen_fakes_{USERNAME4}"
+    config.SIM_GENVERSION = GENVERSION
+
+    print(f"{prefix}: run SNANA simulation using SIMLIB model")
+    if ISTAGE < config.args.start_stage :
+        print(f"\t Already done --> SKIP")
+        return
+
     args           = config.args
     OUTDIR         = config.input_yaml['OUTDIR']
     filters        = config.filters
@@ -330,23 +461,15 @@ def simgen(ISTAGE,config):
         HOSTLIB_FILE   = "NONE"
         HOSTLIB_MSKOPT = 0
 
-    prefix         = stage_prefix(ISTAGE)
     sim_input_file = f"{prefix}_simgen_fakes.input"
     sim_log_file   = f"{prefix}_simgen_fakes.log"
 
     SIM_INPUT_FILE = f"{OUTDIR}/{sim_input_file}"
     SIM_LOG_FILE   = f"{OUTDIR}/{sim_log_file}"
-    GENVERSION     = f"{prefix}_simgen_fakes_{USERNAME4}"
-    config.SIM_GENVERSION = GENVERSION
 
     ranseed = 12345 
     sim_input_lines = []
 
-    print(f"{prefix}: run SNANA simulation using SIMLIB model")
-    if ISTAGE < config.args.start_stage :
-        print(f"\t Already done --> SKIP")
-        return
-
 
     if args.verify :
         OUTDIR_ORIG = config.input_yaml['OUTDIR_ORIG']
@@ -385,12 +508,11 @@ def simgen(ISTAGE,config):
     print(f"\t Run {JOBNAME_SIM} to generate {GENVERSION} ")
     sys.stdout.flush()
 
-    cmd = f"cd {OUTDIR} ; {JOBNAME_SIM} {sim_input_file} > {sim_log_file}"
-    os.system(cmd)
-
-    # check for FATAL error
-    f = open(f"{SIM_LOG_FILE}",  "r")
-    if 'FATAL' in f.read():
+    # check for FATAL error while sim is running, so that sim is
+    # stopped at first FATAL and log is not read again afterwards.
+    found_fatal = run_job([JOBNAME_SIM, sim_input_file], sim_log_file, 
+                          cwd=OUTDIR, stop_string=b'FATAL')
+    if found_fatal :
         sys.exit(f"\n FATAL ERROR: check {SIM_LOG_FILE} \n")
 
     # end simgen
@@ -401,7 +523,6 @@ def make_outlier_table(ISTAGE,config,what):
     # for all observations.
     # Input what = FAKE or SIM
 
-    OUTDIR = config.input_yaml['OUTDIR']
     prefix = stage_prefix(ISTAGE)
     
     nml_prefix   = f"{prefix}_fluxTable_{what}"
@@ -413,6 +534,7 @@ def make_outlier_table(ISTAGE,config,what):
         print(f"\t Already done --> SKIP")
         return table_file
 
+    OUTDIR = config.input_yaml['OUTDIR']
     KCOR_FILE         = config.input_yaml['KCOR_FILE']
 
     if what == STRING_FAKE :
@@ -441,19 +563,59 @@ def make_outlier_table(ISTAGE,config,what):
     run_snana_job(config, nml_prefix, nml_lines)
 
     
-    # compress large TEXT tables
+    # compress large TEXT tables; only gzip tables from this job
+    # in case the other OUTLIER-table job is running in parallel.
     print(f"\t gzip TEXT tables from {JOBNAME_SNANA} ... ")
-    cmd = f"cd {OUTDIR}; gzip STAGE*.TEXT"
-    os.system(cmd)
+    text_list = glob.glob(f"{OUTDIR}/{nml_prefix}*.TEXT")
+    gzip_file_list(text_list)
 
     return table_file 
 
     #y end make_outlier_table
 
+def gzip_file_list(file_list):
+
+    # gzip each file in file_list (file -> file.gz) using one thread
+    # per file; zlib releases the GIL, so the threads compress in
+    # parallel. These tables are only read back by the map stage,
+    # so favor speed over compression ratio.
+
+    if len(file_list) == 0 : return
+    nthread = min(len(file_list), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=nthread) as executor:
+        list(executor.map(gzip_file, file_list))
+
+    # end gzip_file_list
+
+def gzip_file(file_name):
+
+    # use pigz if available; else python gzip module.
+    # Write to temp file first so that an interrupted job never
+    # leaves a truncated .gz file that looks complete.
+
+    if shutil.which('pigz') :
+        subprocess.run(['pigz', f"-{GZIP_LEVEL}", '-f', file_name],
+                       check=True)
+        return
+
+    gz_file  = f"{file_name}.gz"
+    tmp_file = f"{gz_file}.tmp"
+    with open(file_name,'rb') as f_in, \
+         gzip.open(tmp_file, 'wb', compresslevel=GZIP_LEVEL) as f_out :
+        shutil.copyfileobj(f_in, f_out, length=GZIP_BUFSIZE)
+    os.replace(tmp_file, gz_file)
+    os.remove(file_name)
+
+    # end gzip_file
+
 def parse_map_bins(config):
 
     # add map_bins dictionary to config
     # Each input row includes; varname  Nbin min max
+    # If map bins were already parsed from the same input file,
+    # (e.g., restart with -s or --makemap), read them from cache.
+
+    if read_map_bin_cache(config) : return
 
     input_yaml      = config.input_yaml
     FLUXERRMAP_BINS = input_yaml['FLUXERRMAP_BINS']
@@ -487,13 +649,11 @@ def parse_map_bins(config):
     #sys.exit(f"\n xxx FLUXERRMAP_BINS = \n{FLUXERRMAP_BINS}")
 
     NDIM   = 0 
-    NBIN1D = 1
     for row in FLUXERRMAP_BINS:
         NDIM   += 1
         row     = row.split()        
         varname = row[0]
         nbin=int(row[1]);  valmin=float(row[2]); valmax=float(row[3])
-        NBIN1D *= nbin
         bins    = np.linspace(valmin,valmax,nbin+1)
         print(f"    Store {nbin:2d} {varname} bins from {valmin} to {valmax}")
         varname_list.append(varname)
@@ -509,48 +669,8 @@ def parse_map_bins(config):
     if COLNAME_IFILTOBS in varname_header_list :
         varname_header_list.remove(COLNAME_IFILTOBS)
 
-    # - - - - -
-    id_1d = np.arange(NBIN1D)  # 0,1,2 ... NBIN1D-1
-    id_nd = []                 # array of indices for each dimension
-
-    if NDIM == 1 :
-        id0 = np.unravel_index(id_1d,(nbin_list[0]))
-        id_nd.append(id0)
-        indexing_array = np.arange(NBIN1D).reshape((nbin_list[0]))
-    elif NDIM == 2 :
-        id0,id1 = np.unravel_index(id_1d,(nbin_list[0],nbin_list[1]))
-        id_nd.append(id0)
-        id_nd.append(id1)
-        indexing_array = np.arange(NBIN1D).reshape((nbin_list[0],nbin_list[1]))
-    elif NDIM == 3 :
-        id0,id1,id2 = \
-            np.unravel_index(id_1d,(nbin_list[0],nbin_list[1],nbin_list[2]))
-        id_nd.append(id0)
-        id_nd.append(id1)
-        id_nd.append(id2)
-        indexing_array = \
-            np.arange(NBIN1D).reshape((nbin_list[0],nbin_list[1],nbin_list[2]))
-    elif NDIM == 4 :
-        id0,id1,id2,id3 = \
-            np.unravel_index(id_1d,(nbin_list[0],nbin_list[1],nbin_list[2],nbin_list[3]))
-        id_nd.append(id0)
-        id_nd.append(id1)
-        id_nd.append(id2)
-        id_nd.append(id3)
-        indexing_array = \
-            np.arange(NBIN1D).reshape((nbin_list[0],nbin_list[1],nbin_list[2],nbin_list[3]))
-
-    else :
-        sys.exit("\n ERROR: cannot process NDIM={NDIM}\n")
-
-    #print(f" xxx nbin_list = {nbin_list} ")
-    #print(f" xxx id_nd = \n{id_nd}")
-    #print(f" xxx indexing_array=\n{indexing_array} ")
-    #print(f" xxx  idem(1,2) = {indexing_array[1,2]} ")
-
     map_bin_dict = {
         'NDIM'          : NDIM,       # number of map dimensions
-        'NBIN1D'        : NBIN1D,      # total number of multiD bins
         'NVAR'          : len(varname_list),
         'varname_list'  : varname_list ,
         'varname_header_list'  : varname_header_list ,
@@ -558,18 +678,90 @@ def parse_map_bins(config):
         'valmin_list'   : valmin_list ,
         'valmax_list'   : valmax_list ,
         'bin_edge_list' : bin_edge_list ,   # histogram bin edges
-        'id_1d'         : id_1d,
-        'id_nd'         : id_nd,
-        'indexing_array': indexing_array,
         'ivar_field'    : ivar_field,
         'ivar_filter'   : ivar_filter   # flag to make filter-dependent maps        
     }
 
+    # load NBIN1D and 1D <-> multi-D index arrays
+    set_map_bin_indices(map_bin_dict)
+
     config.map_bin_dict = map_bin_dict
+    write_map_bin_cache(config)
     sys.stdout.flush()
 
     # end parse_map_bins
 
+def set_map_bin_indices(map_bin_dict):
+
+    # load total number of multi-D bins (NBIN1D) and arrays to convert
+    # between 1D and multi-D bin indices. Called again if number of
+    # bins changes for any map variable.
+
+    nbin_list = map_bin_dict['nbin_list']
+    NBIN1D    = int(np.prod(nbin_list))
+
+    # id_nd[ivar,BIN1D] is index along dimension ivar for 1D bin BIN1D;
+    # same row-major order as indexing_array and ravel_multi_index.
+    shape = tuple(nbin_list)
+    id_1d = np.arange(NBIN1D)  # 0,1,2 ... NBIN1D-1
+    id_nd = np.stack(np.unravel_index(id_1d, shape)).astype(np.int32)
+    indexing_array = id_1d.reshape(shape)
+
+    map_bin_dict['NBIN1D']         = NBIN1D   # total number of multiD bins
+    map_bin_dict['id_1d']          = id_1d
+    map_bin_dict['id_nd']          = id_nd
+    map_bin_dict['indexing_array'] = indexing_array
+
+    # end set_map_bin_indices
+
+def get_map_bin_cache_key(config):
+
+    # return key that changes if either the input file or this 
+    # script is modified; avoids re-using map bins from stale cache.
+    input_file = config.args.input_file
+    with open(input_file,'rb') as f:
+        input_hash = hashlib.md5(f.read()).hexdigest()
+    return (input_hash, os.path.getmtime(__file__))
+
+    # end get_map_bin_cache_key
+
+def read_map_bin_cache(config):
+
+    # if map-bin cache exists with matching key, load map_bin_dict
+    # into config and return True; else return False.
+
+    OUTDIR     = config.input_yaml['OUTDIR']
+    cache_file = f"{OUTDIR}/{MAP_BIN_CACHE_FILE}"
+    if not os.path.exists(cache_file) : return False
+
+    with open(cache_file,'rb') as f:
+        cache = pickle.load(f)
+
+    if cache.key != get_map_bin_cache_key(config) : return False
+
+    print(f"    Read map bins from {cache_file}")
+    for varname, nbin, valmin, valmax in \
+        zip(cache.map_bin_dict['varname_list'], cache.map_bin_dict['nbin_list'],
+            cache.map_bin_dict['valmin_list'],  cache.map_bin_dict['valmax_list']):
+        print(f"    Found {nbin:2d} {varname} bins from {valmin} to {valmax}")
+
+    config.map_bin_dict = cache.map_bin_dict
+    sys.stdout.flush()
+    return True
+
+    # end read_map_bin_cache
+
+def write_map_bin_cache(config):
+
+    OUTDIR     = config.input_yaml['OUTDIR']
+    cache_file = f"{OUTDIR}/{MAP_BIN_CACHE_FILE}"
+    cache      = Namespace(key          = get_map_bin_cache_key(config),
+                           map_bin_dict = config.map_bin_dict)
+    with open(cache_file,'wb') as f:
+        pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # end write_map_bin_cache
+
 def make_fluxerr_model_map(ISTAGE,config):
 
     #
@@ -594,9 +786,15 @@ def make_fluxerr_model_map(ISTAGE,config):
     if not os.path.exists(flux_table_fake):  flux_table_fake += '.gz'
     if not os.path.exists(flux_table_sim):   flux_table_sim  += '.gz'
 
-    # read each table
-    df_fake = store_flux_table(flux_table_fake, map_bin_dict)
-    df_sim  = store_flux_table(flux_table_sim,  map_bin_dict)
+    # read each table; the two reads are independent, and gunzip and
+    # pandas C parser release the GIL, so read both tables in parallel.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        future_fake = executor.submit(store_flux_table, 
+                                      flux_table_fake, map_bin_dict)
+        future_sim  = executor.submit(store_flux_table, 
+                                      flux_table_sim,  map_bin_dict)
+        df_fake = future_fake.result()
+        df_sim  = future_sim.result()
 
     # load list of unique ifiltobs & band into map_bin_dict.ifiltobs_set, band_set
     get_filter_list(df_fake, map_bin_dict)
@@ -609,9 +807,12 @@ def make_fluxerr_model_map(ISTAGE,config):
     #print(f"\n xxx df_fake = \n{df_fake}")
     # - - - - - 
 
-    # open output map files
-    f_fake = open(fluxerrmodel_file_fake,"wt")
-    f_sim  = open(fluxerrmodel_file_sim, "wt")
+    # open output map files with large buffer; map rows are collected
+    # in lists and written in chunks of MAP_NROW_WRITE rows.
+    f_fake = open(fluxerrmodel_file_fake, "wt", buffering=MAP_BUFSIZE)
+    f_sim  = open(fluxerrmodel_file_sim,  "wt", buffering=MAP_BUFSIZE)
+    lines_fake = []
+    lines_sim  = []
 
     write_map_global_header(f_fake, STRING_FAKE, config)
     write_map_global_header(f_sim,  STRING_SIM,  config)
@@ -625,50 +826,72 @@ def make_fluxerr_model_map(ISTAGE,config):
     ifiltobs_last = -9
     ifield_last   = -9
 
-    # if there is no filter dependence, write one header 
-    # with BAND specifying all bands.
-    if ivar_filter < 0 :
-        write_map_header(f_fake, -9, config)
-        write_map_header(f_sim,  -9, config)
-
     # start loop over 1D bins (which loops over all dimensions of map)
 
+    # count obs in each 1D bin with one pass over each table,
+    # and sort each table by bin once so that every 1D bin is a
+    # contiguous slice of numpy arrays (no per-bin table scans).
+    nobs_fake = np.bincount(df_fake[COLNAME_BIN1D], minlength=NBIN1D)
+    nobs_sim  = np.bincount(df_sim[COLNAME_BIN1D],  minlength=NBIN1D)
+
+    pull_fake_arr, ratio_fake_arr, offset_fake = \
+        sort_by_bin(df_fake, ['PULL', 'ERR_RATIO'], nobs_fake)
+    pull_sim_arr,  offset_sim  = \
+        sort_by_bin(df_sim,  ['PULL'],              nobs_sim)
+
+    # compute errScale correction for fake and sim in every 1D bin
+    cor_fake_arr, cor_sim_arr = \
+        compute_errscale_cor_map(pull_fake_arr, ratio_fake_arr, offset_fake,
+                                 pull_sim_arr,  offset_sim)
+
+    grid_arr, last_row_arr = get_map_grid(map_bin_dict)
+
     print(f" Begin loop over {NBIN1D} 1D map bins ... ")
     sys.stdout.flush()
 
     for BIN1D in range(0,NBIN1D):
 
         ifield = -9
-        if ivar_field >= 0: ifield = id_nd[ivar_field][BIN1D]
+        if ivar_field >= 0: ifield = id_nd[ivar_field,BIN1D]
 
-        # check for start of filter-dependent map
-        use_filter = True
+        # if there is no filter dependence, ifiltobs=-9 and header
+        # has BAND specifying all bands.
+        ifiltobs = -9
         if ivar_filter >= 0:
-            ifiltobs   = id_nd[ivar_filter][BIN1D]
-            use_filter = ifiltobs in ifiltobs_list
-            if use_filter and ifiltobs != ifiltobs_last :
-                write_map_header(f_fake, ifield, ifiltobs, config)
-                write_map_header(f_sim,  ifield, ifiltobs, config)
-                
-            ifiltobs_last = ifiltobs
-
-        if not use_filter : continue  # skip the pad zeros in ifiltobs_list
-
-        # select sample in this BIN1D (this multi-D cell)
-        pull_fake = \
-            df_fake['PULL'].to_numpy()[np.where(df_fake[COLNAME_BIN1D]==BIN1D)]
-        pull_sim = \
-            df_sim['PULL'].to_numpy()[np.where(df_sim[COLNAME_BIN1D]==BIN1D)]
-        ratio_fake = \
-            df_fake['ERR_RATIO'].to_numpy()[np.where(df_fake[COLNAME_BIN1D]==BIN1D)]
-
-        # compute errScale correction for fake and sim
-        n_fake, n_sim, cor_fake, cor_sim = \
-            compute_errscale_cor ( pull_fake, pull_sim, ratio_fake )
+            ifiltobs   = ifiltobs_list[id_nd[ivar_filter,BIN1D]]
+
+        # check for start of new map; new map starts when either filter 
+        # or field group changes (e.g., single filter with several 
+        # field groups, or field groups without filter dependence).
+        new_map = BIN1D == 0 or \
+                  ifiltobs != ifiltobs_last or ifield != ifield_last
+        if new_map :
+            write_map_lines(f_fake, lines_fake)
+            write_map_lines(f_sim,  lines_sim)
+            write_map_header(f_fake, ifield, ifiltobs, config)
+            write_map_header(f_sim,  ifield, ifiltobs, config)
+
+        ifiltobs_last = ifiltobs
+        ifield_last   = ifield
+
+        n_fake   = nobs_fake[BIN1D]
+        n_sim    = nobs_sim[BIN1D]
+        cor_fake = cor_fake_arr[BIN1D]
+        cor_sim  = cor_sim_arr[BIN1D]
+        grid     = grid_arr[BIN1D]
+        last_row = last_row_arr[BIN1D]
 
         # update map files.
-        write_map_row(f_fake, config, BIN1D, cor_fake, n_fake, -9)
-        write_map_row(f_sim,  config, BIN1D, cor_sim,  n_fake, n_sim )
+        write_map_row(lines_fake, grid, last_row, cor_fake, n_fake, -9)
+        write_map_row(lines_sim,  grid, last_row, cor_sim,  n_fake, n_sim )
+        if len(lines_fake) >= MAP_NROW_WRITE :
+            write_map_lines(f_fake, lines_fake)
+            write_map_lines(f_sim,  lines_sim)
+
+    write_map_lines(f_fake, lines_fake)
+    write_map_lines(f_sim,  lines_sim)
+    f_fake.close()
+    f_sim.close()
 
     # - - - 
     print("\n")
@@ -703,21 +926,20 @@ def  modify_tables(df_fake, df_sim, config):
     id_nd          = map_bin_dict['id_nd'] 
     ivar_filter    = map_bin_dict['ivar_filter']
 
-    # apply optional cuts on NSIG and ERR_RATIO
+    # apply optional cut on NSIG, and for filter-dependent map, 
+    # reject obs in filters not found in fakes (e.g., extra filter 
+    # in sim). All cuts are combined into one boolean mask per table
+    # so that each table is sliced (and re-indexed) only once.
 
     nrow_orig_fake = len(df_fake)
     nrow_orig_sim  = len(df_sim)
 
-    key = 'CUTWIN_NSIG'
-    if key in input_yaml :
-        cutwin_nsig = input_yaml[key].split()
-        nsig_max    = float(cutwin_nsig[1])
-        df_fake     = df_fake.loc[ df_fake['NSIG'] < nsig_max ]
-        df_sim      = df_sim.loc[  df_sim['NSIG']  < nsig_max ]
+    df_fake     = df_fake.loc[ get_cut_mask(df_fake, config) ]
+    df_sim      = df_sim.loc[  get_cut_mask(df_sim,  config) ]
 
-        # reset indices
-        df_fake     = df_fake.reset_index()
-        df_sim      = df_sim.reset_index()
+    # reset indices
+    df_fake     = df_fake.reset_index(drop=True)
+    df_sim      = df_sim.reset_index(drop=True)
 
     #sys.exit(f"\n xxx df_fake = \n{df_fake}\n")
 
@@ -730,77 +952,167 @@ def  modify_tables(df_fake, df_sim, config):
     print(f" Nrow(sim)  = {nrow_orig_sim} -> {nrow_sim} after cuts.")
     sys.stdout.flush()
 
-    # - - - - 
-    # force variables in map to lie within map ranges e.g., 
-    # if LOGSNR has 5 bins from 0.3 to 2.3, then LOGSNR<0.3 -> 0.30001
-    force_bounds(df_fake, config)
-    force_bounds(df_sim,  config)
-
     # assign integer IDFIELD = 0, 1, 2, ... NFIELD_GROUP-1 to each row
     NFIELD_GROUP = input_yaml['NFIELD_GROUP']
     if NFIELD_GROUP > 0 :
-        FIELD_LISTS = input_yaml['FIELD_GROUP_LISTS']
         print(f"   Add {COLNAME_IFIELD} column to tables ...")
-        df_fake[COLNAME_IFIELD] = \
-            df_fake.apply(lambda row: apply_field(row,FIELD_LISTS), axis=1)
-
-        df_sim[COLNAME_IFIELD] = \
-            df_sim.apply(lambda row: apply_field(row,FIELD_LISTS), axis=1)
+        df_fake[COLNAME_IFIELD] = apply_field(df_fake, input_yaml)
+        df_sim[COLNAME_IFIELD]  = apply_field(df_sim,  input_yaml)
         
     #sys.exit(f"\n xxx BYE BYE df_fake=\n{df_fake}\n")
 
     # - - - - - 
-    # digitize the variables used in map; i.e., compute multi-D
-    # index for each map-variable and each row in table.
-    ivar=0
-    ibins_fake = [ ];   ibins_sim = [ ]  # init arrays of multi-D indices
-    for varname, bins in zip(varname_list, bin_edge_list):
-        dfcol_fake = df_fake[varname]
-        dfcol_sim  = df_sim[varname]
-        ibins_fake.append(np.digitize(dfcol_fake, bins))
-        ibins_sim.append(np.digitize( dfcol_sim,  bins))
-        ivarname = f"i_{varname}"  
-        df_fake[ivarname] = ibins_fake[ivar] - 1
-        df_sim[ivarname]  = ibins_sim[ivar]  - 1
-        ivar += 1
-
-    # add 1d index colum to each flux table to enable easy selection
-    # of multi-D cells from 1D index.
+    # add multi-D index column for each map-variable, and 1d index 
+    # column to each flux table to enable easy selection of multi-D 
+    # cells from 1D index.
     print(f"   Add {COLNAME_BIN1D} column to tables ...")
-    df_fake[COLNAME_BIN1D] = \
-        df_fake.apply(lambda row: apply_id_1d(row,map_bin_dict), axis=1)
-
-    df_sim[COLNAME_BIN1D] = \
-        df_sim.apply(lambda row: apply_id_1d(row,map_bin_dict), axis=1)
+    add_bin_columns(df_fake, map_bin_dict)
+    add_bin_columns(df_sim,  map_bin_dict)
 
     return df_fake, df_sim
 
     # end modify_tables
 
-def force_bounds(df,config):
+def add_bin_columns(df, map_bin_dict):
+
+    # digitize the variables used in map; i.e., compute multi-D
+    # index i_[varname] for each map-variable and each row in table.
+    # Values outside map range are pulled into first/last bin.
+    # The 1D index (COLNAME_BIN1D) is built with np.ravel_multi_index
+    # in the same row-major order as indexing_array, so that the whole
+    # table is binned with a few numpy passes instead of a per-row apply.
+
+    # Index columns use the smallest int type for their number of bins
+    # (int8 for FIELD, FILTER and typical histogram bins) so that the
+    # 1D index is computed over narrow contiguous arrays.
+
+    NBIN1D         = map_bin_dict['NBIN1D']
+    varname_list   = map_bin_dict['varname_list']
+    nbin_list      = map_bin_dict['nbin_list']
+    bin_edge_list  = map_bin_dict['bin_edge_list']
+    ivar_filter    = map_bin_dict['ivar_filter']
+
+    ibin_list = []
+    for ivar, (varname, nbin, bins) in \
+        enumerate(zip(varname_list, nbin_list, bin_edge_list)):
+        values = df[varname].to_numpy()
+        if ivar == ivar_filter :
+            values = map_bin_dict['ifiltobs_lut'][values] # IFILTOBS -> ifilt
+        # same bins as np.digitize(values,bins)-1; values exactly on
+        # an edge go to the upper bin. Binary search over the few edges
+        # (no arithmetic rescale) so that edge values are exact.
+        ibin   = np.searchsorted(bins, values, side='right') - 1
+        np.clip(ibin, 0, nbin-1, out=ibin)
+        ibin   = ibin.astype(get_index_dtype(nbin))
+        df[f"i_{varname}"] = ibin
+        ibin_list.append(ibin)
+
+    id_1d = np.ravel_multi_index(ibin_list, dims=tuple(nbin_list), mode='clip')
+    df[COLNAME_BIN1D] = id_1d.astype(get_index_dtype(NBIN1D))
+
+    # end add_bin_columns
+
+def get_index_dtype(nbin):
+
+    # return smallest signed int dtype that holds index 0 to nbin-1
+    for dtype in [ np.int8, np.int16, np.int32 ] :
+        if nbin-1 <= np.iinfo(dtype).max : return dtype
+    return np.int64
+
+    # end get_index_dtype
+
+def get_cut_mask(df, config):
+
+    # return boolean mask (one element per row) that is True for rows 
+    # passing cuts. Each cut is a vectorized compare on numpy column.
+    # Note that CUTWIN_ERRTEST is applied by snana.exe, not here.
 
     map_bin_dict = config.map_bin_dict
-    varname_list = map_bin_dict['varname_list']
-    valmin_list  = map_bin_dict['valmin_list']
-    valmax_list  = map_bin_dict['valmax_list']
-
-    for varname,valmin,valmax in zip(varname_list,valmin_list,valmax_list):
-        if varname == COLNAME_IFILTOBS : continue
-        if varname == COLNAME_IFIELD   : continue
-        print(f"\t Force {valmin} < {varname} < {valmax}")
-        df[varname] = df[varname].where(df[varname] > valmin, valmin+0.0001)
-        df[varname] = df[varname].where(df[varname] < valmax, valmax-0.0001)
-        
-    sys.stdout.flush()
-    # end force_bounds
+    input_yaml   = config.input_yaml
+    ivar_filter  = map_bin_dict['ivar_filter']
+
+    mask = np.ones(len(df), dtype=bool)
+
+    key = 'CUTWIN_NSIG'
+    if key in input_yaml :
+        cutwin_nsig = input_yaml[key].split()
+        nsig_max    = float(cutwin_nsig[1])
+        mask       &= df['NSIG'].to_numpy() < nsig_max
+
+    if ivar_filter >= 0 :
+        ifiltobs_lut = map_bin_dict['ifiltobs_lut']
+        mask        &= ifiltobs_lut[df[COLNAME_IFILTOBS].to_numpy()] >= 0
+
+    return mask
+
+    # end get_cut_mask
+
+def sort_by_bin(df, colname_list, nobs):
+
+    # return contiguous float32 arrays for each column in colname_list,
+    # sorted by COLNAME_BIN1D, followed by array of bin offsets such 
+    # that 1D bin BIN1D is [offset[BIN1D]:offset[BIN1D+1]].
+    # Input nobs is number of obs per 1D bin (from np.bincount).
+
+    isort  = np.argsort(df[COLNAME_BIN1D].to_numpy(), kind='stable')
+    offset = np.concatenate(([0], np.cumsum(nobs)))
+
+    sorted_list = []
+    for colname in colname_list:
+        values = df[colname].to_numpy(dtype=np.float32)
+        sorted_list.append(values[isort])
 
+    return (*sorted_list, offset)
 
-def compute_errscale_cor(pull_fake, pull_sim, ratio_fake):
+    # end sort_by_bin
+
+def compute_errscale_cor_map(pull_fake, ratio_fake, offset_fake,
+                             pull_sim, offset_sim):
+
+    # return arrays of ERRSCALE corrections (cor_fake, cor_sim) for
+    # every 1D bin. Inputs are bin-sorted arrays and bin offsets
+    # from sort_by_bin. Bins are independent, so with numba they
+    # are computed in parallel threads; otherwise compute all bins 
+    # at once with vectorized groupby medians.
+
+    if HAS_NUMBA:
+        return errscale_cor_kernel(pull_fake, ratio_fake, offset_fake,
+                                   pull_sim, offset_sim, NOBS_MIN_BIN)
+    else:
+        return compute_errscale_cor(pull_fake, ratio_fake, offset_fake,
+                                    pull_sim, offset_sim)
+
+    # end compute_errscale_cor_map
+
+if HAS_NUMBA:
+    @numba.njit(parallel=True, cache=True)
+    def errscale_cor_kernel(pull_fake, ratio_fake, offset_fake,
+                            pull_sim, offset_sim, nobs_min):
+        # numba version of compute_errscale_cor; loop over 1D bins
+        NBIN1D   = offset_fake.size - 1
+        cor_fake = np.ones(NBIN1D)
+        cor_sim  = np.ones(NBIN1D)
+        for BIN1D in numba.prange(NBIN1D):
+            i0 = offset_fake[BIN1D];  i1 = offset_fake[BIN1D+1]
+            j0 = offset_sim[BIN1D];   j1 = offset_sim[BIN1D+1]
+            if i1-i0 > nobs_min and j1-j0 > nobs_min :
+                pf = pull_fake[i0:i1]
+                ps = pull_sim[j0:j1]
+                rms_pull_fake  = 1.48 * np.median(np.absolute(pf-np.median(pf)))
+                rms_pull_sim   = 1.48 * np.median(np.absolute(ps-np.median(ps)))
+                avg_ratio      = np.median(ratio_fake[i0:i1])
+                cor_fake[BIN1D] = rms_pull_fake / avg_ratio
+                cor_sim[BIN1D]  = rms_pull_fake / rms_pull_sim
+        return cor_fake, cor_sim
+
+def compute_errscale_cor(pull_fake, ratio_fake, offset_fake,
+                         pull_sim, offset_sim):
     
-    # for this 1D bin, compute ERRSCALE correction for FAKE(data) and SIM.
+    # for each 1D bin, compute ERRSCALE correction for FAKE(data) and SIM.
     #  + pull_fake a list of PULL = (F-Ftrue)/ERR_CALC
     #  + pull_sim  is the same for sime
     #  + ratio_fake is list of ERR_DATA/ERR_CALC [fakes]
+    #  + offset_[fake,sim] are bin offsets from sort_by_bin
     #
     #  From  Sec 6.4 of https://arxiv.org/pdf/1811.02379.pdf 
     #
@@ -809,38 +1121,53 @@ def compute_errscale_cor(pull_fake, pull_sim, ratio_fake):
     #
     #  Eq 14 for SIM (intended for sim)
     #     scale = RMS[(F-Ftrue)/ERRCALC]_fake / RMS[(F-Ftrue)/ERRCALC]_sim
+    #
+    # Each median is one groupby over all bins (no python loop over bins).
 
-    n_fake = len(pull_fake)
-    n_sim  = len(pull_sim)
-    if n_fake > 5 and n_sim > 5 :
+    ibin_fake = get_bin_ids(offset_fake)
+    ibin_sim  = get_bin_ids(offset_sim)
 
-        # shift pulls so that median/avg is zero
-        avg_pull_fake  = np.median(pull_fake)
-        avg_pull_sim   = np.median(pull_sim)
-        pull_fake      = pull_fake - avg_pull_fake
-        pull_sim       = pull_sim  - avg_pull_sim
+    # shift pulls so that median/avg is zero
+    avg_pull_fake  = bin_median(pull_fake, ibin_fake, offset_fake)
+    avg_pull_sim   = bin_median(pull_sim,  ibin_sim,  offset_sim)
+    pull_fake      = pull_fake - avg_pull_fake[ibin_fake]
+    pull_sim       = pull_sim  - avg_pull_sim[ibin_sim]
 
-        # for RMS, compute 1.48*median|pull| to reduce sensitivity to outliers
-        rms_pull_fake  = 1.48 * np.median(np.absolute(pull_fake))
-        rms_pull_sim   = 1.48 * np.median(np.absolute(pull_sim))
+    # for RMS, compute 1.48*median|pull| to reduce sensitivity to outliers
+    rms_pull_fake  = 1.48 * bin_median(np.absolute(pull_fake), ibin_fake, offset_fake)
+    rms_pull_sim   = 1.48 * bin_median(np.absolute(pull_sim),  ibin_sim,  offset_sim)
 
-        avg_ratio      = np.median(ratio_fake)  # ERR_DATA/ERR_CALC
+    avg_ratio      = bin_median(ratio_fake, ibin_fake, offset_fake) # ERR_DATA/ERR_CALC
 
-        # finally, the map corrections
-        cor_fake       = rms_pull_fake / avg_ratio     # correct fake & data
-        cor_sim        = rms_pull_fake / rms_pull_sim  # correct sims
-        
-        #print(f"\t xxx cor_sim = {rms_pull_fake:.3f} / {rms_pull_sim:.3f}" \
-        #      f" = {cor_fake:.3f}  " \
-        #      f" (avgPull={avg_pull_fake:.3f},{avg_pull_sim:0.3f}) " )
+    # finally, the map corrections; 1 for bins with too few obs
+    n_fake   = np.diff(offset_fake)
+    n_sim    = np.diff(offset_sim)
+    use_bin  = (n_fake > NOBS_MIN_BIN) & (n_sim > NOBS_MIN_BIN)
 
-    else:
-        cor_fake = 1.0 ; cor_sim = 1.0
+    cor_fake = np.ones(len(n_fake))
+    cor_sim  = np.ones(len(n_sim))
+    cor_fake[use_bin] = rms_pull_fake[use_bin] / avg_ratio[use_bin]    # correct fake & data
+    cor_sim[use_bin]  = rms_pull_fake[use_bin] / rms_pull_sim[use_bin] # correct sims
 
-    return n_fake, n_sim, cor_fake, cor_sim
+    return cor_fake, cor_sim
 
     # end compute_errscale_cor
 
+def get_bin_ids(offset):
+    # return 1D bin index for each element of bin-sorted array
+    NBIN1D = len(offset) - 1
+    return np.repeat(np.arange(NBIN1D), np.diff(offset))
+
+    # end get_bin_ids
+
+def bin_median(values, ibin, offset):
+    # return median of values in each 1D bin (NaN for empty bin)
+    NBIN1D = len(offset) - 1
+    median = pd.Series(values).groupby(ibin).median()
+    return median.reindex(np.arange(NBIN1D)).to_numpy()
+
+    # end bin_median
+
 def write_map_global_header(f, what, config):
     
     # write global comments and one-time keys.
@@ -899,7 +1226,6 @@ def write_map_global_header(f, what, config):
         snana_field_list = '+'.join(field_list)
         f.write(f"DEFINE_FIELDGROUP: {field_name}  {snana_field_list}\n")
 
-    f.flush()
     # end write_map_define_fields
 
 def write_map_header(f, ifield, ifiltobs, config):
@@ -928,38 +1254,57 @@ def write_map_header(f, ifield, ifiltobs, config):
     f.write(f"BAND: {band_arg} \n")
     f.write(f"VARNAMES: {varlist}   ERRSCALE\n")
 
-    f.flush()
     # end write_map_header
 
-def write_map_row(f, config, BIN1D, cor, n_fake, n_sim ):
+def write_map_lines(f, lines):
 
-    # write map row corresponding to 1D index BIN1D
-    # cor is the ERRSCALE correction 
+    # write lines collected by write_map_row, and clear the list
+    f.writelines(lines)
+    lines.clear()
+
+    # end write_map_lines
+
+def get_map_grid(map_bin_dict):
+
+    # return grid values (bin centers) of the map variables written on
+    # each ROW, as array [BIN1D,ivar], and boolean array that is True 
+    # for the last row of each map. FIELD and FILTER are excluded since 
+    # they define separate maps. Computed for all 1D bins at once so that 
+    # write_map_row only formats numbers.
 
-    map_bin_dict    = config.map_bin_dict
-    bin_edge_list   = map_bin_dict['bin_edge_list']
     NVAR            = map_bin_dict['NVAR']
+    NBIN1D          = map_bin_dict['NBIN1D']
     id_nd           = map_bin_dict['id_nd']
-    varname_list    = map_bin_dict['varname_list']
+    bin_edge_list   = map_bin_dict['bin_edge_list']
+    nbin_list       = map_bin_dict['nbin_list']
     ivar_field      = map_bin_dict['ivar_field']
     ivar_filter     = map_bin_dict['ivar_filter']
-    nbin_list       = map_bin_dict['nbin_list']
 
-    #print(f" bin_list = {bin_list}")
-    # convert to multi-D indices and extract grid values
-    row_line = 'ROW: '
-    last_row = True
-
-    for ivar in range(0,NVAR):
-        if ivar == ivar_field  : continue
-        if ivar == ivar_filter : continue
-        itmp       = id_nd[ivar][BIN1D]
-        lo_edge    = bin_edge_list[ivar][itmp]
-        hi_edge    = bin_edge_list[ivar][itmp+1]
-        bin_center = 0.5*(lo_edge + hi_edge)
-        row_line  += f"{bin_center:8.4f}  "
-        if itmp < nbin_list[ivar]-1 : last_row = False
+    ivar_list  = [ ivar for ivar in range(0,NVAR) 
+                   if ivar not in [ ivar_field, ivar_filter ] ]
+
+    grid_list  = []
+    for ivar in ivar_list :
+        edges      = bin_edge_list[ivar]
+        bin_center = 0.5*(edges[:-1] + edges[1:])
+        grid_list.append(bin_center[id_nd[ivar]])
+    grid_arr = np.array(grid_list).reshape(len(ivar_list),NBIN1D).T
+
+    nbin_last    = np.array(nbin_list)[ivar_list] - 1
+    last_row_arr = np.all(id_nd[ivar_list] == nbin_last[:,None], axis=0)
+
+    return grid_arr, last_row_arr
 
+    # end get_map_grid
+
+def write_map_row(lines, grid, last_row, cor, n_fake, n_sim ):
+
+    # append map row to list of lines; lines are written to map file 
+    # by write_map_lines. grid is list of bin centers for row, and 
+    # cor is the ERRSCALE correction. If last_row, also end map.
+
+    row_line  = 'ROW: '
+    row_line += ''.join([ f"{val:8.4f}  " for val in grid ])
     row_line += f"{cor:8.3f}"
 
     # prepare comment with stats
@@ -968,50 +1313,135 @@ def write_map_row(f, config, BIN1D, cor, n_fake, n_sim ):
     else :
         comment = f"N_FAKE = {n_fake} "
 
-    f.write(f"{row_line}    # {comment} \n")
+    lines.append(f"{row_line}    # {comment} \n")
 
     if last_row:   
-        f.write("ENDMAP:\n\n")
-        f.flush()
+        lines.append("ENDMAP:\n\n")
 
     # end write_map_row
 
 def store_flux_table(flux_table, map_bin_dict):
 
-
-    df = pd.read_csv(flux_table, comment="#", delim_whitespace=True)
-
-    nrow = len(df)
-    print(f"    Read/store {flux_table} with {nrow} rows.")
-
     STR_F        = 'FLUXCAL_DATA' ; 
     STR_FTRUE    = 'FLUXCAL_TRUE' ; 
     STR_ERR      = 'FLUXCAL_ERR_DATA'
     STR_ERR_CALC = 'FLUXCAL_ERR_CALC'
 
-    # compute modified PULL with ERR -> ERR_CALC
-    pull = (df[STR_F]-df[STR_FTRUE])/df[STR_ERR_CALC] 
-    df['PULL'] = pull.values
+    # BAND and FIELD are a few repeated strings; parse them directly
+    # into category (small-int codes) instead of python-string objects.
+    # Fluxes have only a few significant digits, so store as float32
+    # (and hence PULL and ERR_RATIO) to halve memory traffic; map 
+    # variables keep full precision so that bin assignment is exact.
+    # IFILTOBS is at most IFILTOBS_MAX, so use narrow int.
+    dtype_dict = { COLNAME_BAND : 'category',  COLNAME_FIELD : 'category',
+                   COLNAME_IFILTOBS : get_index_dtype(IFILTOBS_MAX+1) }
+    for colname in [ STR_F, STR_FTRUE, STR_ERR, STR_ERR_CALC, 'NSIG' ] :
+        dtype_dict[colname] = np.float32
+
+    # columns used to make maps; FIELD bins use IFIELD computed later
+    colname_list = [ STR_F, STR_FTRUE, STR_ERR, STR_ERR_CALC, 
+                     COLNAME_BAND, COLNAME_FIELD, COLNAME_IFILTOBS, 'NSIG' ]
+    for varname in map_bin_dict['varname_list']:
+        if varname != COLNAME_IFIELD and varname not in colname_list:
+            colname_list.append(varname)
+
+    df = read_flux_table(flux_table, dtype_dict, colname_list)
+
+    nrow = len(df)
+    print(f"    Read/store {flux_table} with {nrow} rows.")
 
-    err_ratio  = df[STR_ERR] / df[STR_ERR_CALC]
-    df['ERR_RATIO'] = err_ratio.values
+    # compute modified PULL with ERR -> ERR_CALC, and ERR_RATIO
+    pull, err_ratio = compute_pull_ratio(df[STR_F].to_numpy(),
+                                         df[STR_FTRUE].to_numpy(),
+                                         df[STR_ERR].to_numpy(),
+                                         df[STR_ERR_CALC].to_numpy())
+    df['PULL']      = pull
+    df['ERR_RATIO'] = err_ratio
 
     return df
 
     # end store_flux_table
 
+def compute_pull_ratio(flux, flux_true, err, err_calc):
+
+    # return PULL = (flux-flux_true)/err_calc and ERR_RATIO = err/err_calc
+    # for float32 column arrays. With numba, both are computed in one
+    # pass over the rows; otherwise with numpy, PULL in place in one 
+    # output buffer. Kernel is serial because store_flux_table runs in 
+    # two threads (FAKE & SIM), and numba parallel kernels must not be
+    # launched from several threads at once.
+
+    if HAS_NUMBA:
+        return pull_ratio_kernel(flux, flux_true, err, err_calc)
+
+    pull = np.subtract(flux, flux_true)
+    np.divide(pull, err_calc, out=pull)
+    err_ratio = np.divide(err, err_calc)
+    return pull, err_ratio
+
+    # end compute_pull_ratio
+
+if HAS_NUMBA:
+    @numba.njit(cache=True, error_model='numpy')
+    def pull_ratio_kernel(flux, flux_true, err, err_calc):
+        # numba version of compute_pull_ratio; loop over rows.
+        # numpy error model so that ERR_CALC=0 gives inf (as numpy)
+        # instead of ZeroDivisionError.
+        pull      = np.empty_like(flux)
+        err_ratio = np.empty_like(err)
+        for i in range(flux.size):
+            pull[i]      = (flux[i] - flux_true[i]) / err_calc[i]
+            err_ratio[i] = err[i] / err_calc[i]
+        return pull, err_ratio
+
+def read_flux_table(flux_table, dtype_dict, colname_list):
+
+    # Read columns in colname_list from TEXT flux_table into dataframe;
+    # other columns are skipped by the parser. Gzipped table is 
+    # decompressed by pandas as it is read.
+    # If pyarrow is available, the first read also writes a parquet
+    # copy of the table, and later reads (e.g., to tune map bins
+    # with --makemap) use the parquet copy instead. Parquet copy is
+    # ignored if older than flux_table, or if it is missing any column 
+    # in colname_list (e.g., after adding map variable). Columns from
+    # parquet copy are cast to dtype_dict in case the copy was written
+    # with other dtypes.
+
+    cache_file = flux_table.replace('.gz','').replace('.TEXT','.parquet')
+
+    if HAS_PYARROW and os.path.exists(cache_file) and \
+       os.path.getmtime(cache_file) > os.path.getmtime(flux_table) :
+        cache_colnames = pyarrow.parquet.read_schema(cache_file).names
+        if set(colname_list) <= set(cache_colnames) :
+            print(f"    Read {len(colname_list)} columns from {cache_file}")
+            df = pd.read_parquet(cache_file, columns=colname_list)
+            return df.astype(dtype_dict, copy=False)
+
+    df = pd.read_csv(flux_table, comment="#", sep=r'\s+', engine='c',
+                     usecols=lambda colname: colname in colname_list,
+                     dtype=dtype_dict, compression='infer')
+
+    if HAS_PYARROW :
+        df.to_parquet(cache_file, compression='zstd', row_group_size=1<<20)
+
+    return df
+
+    # end read_flux_table
+
 def get_filter_list(df, map_bin_dict):
 
-    # get unique list of IFILTOBS and BAND 
+    # get unique list of IFILTOBS and BAND; one pass over table keeps
+    # first row for each IFILTOBS instead of one table scan per filter.
+
+    df_uniq = df[[COLNAME_IFILTOBS, COLNAME_BAND]]
+    df_uniq = df_uniq.drop_duplicates(COLNAME_IFILTOBS)
+    df_uniq = df_uniq.sort_values(COLNAME_IFILTOBS)
 
-    ifiltobs_list = sorted(list(set(df[COLNAME_IFILTOBS])))
-    band_list     = []
+    ifiltobs_list = df_uniq[COLNAME_IFILTOBS].tolist()
+    band_list     = df_uniq[COLNAME_BAND].tolist()
     band_map      = [ -9 ]*100
 
-    for ifiltobs in ifiltobs_list :
-        indx = df[df[COLNAME_IFILTOBS] == ifiltobs].index[0]
-        band = df[COLNAME_BAND][indx]
-        band_list.append(band)
+    for ifiltobs, band in zip(ifiltobs_list, band_list):
         band_map[ifiltobs] = band
 
     band_string = ''.join(band_list)
@@ -1022,73 +1452,51 @@ def get_filter_list(df, map_bin_dict):
     map_bin_dict['band_list']      = band_list
     map_bin_dict['band_map']       = band_map
     map_bin_dict['band_string']    = band_string
+
+    # lookup table to remap IFILTOBS -> 0, 1, ... NFILT-1 (or -1 for
+    # filters not found above) with a single fancy-index pass.
+    ifiltobs_lut = np.full(IFILTOBS_MAX+1, -1, dtype=np.int8)
+    ifiltobs_lut[ifiltobs_list] = np.arange(len(ifiltobs_list))
+    map_bin_dict['ifiltobs_lut']   = ifiltobs_lut
+
+    # for filter-dependent map, replace the IFILTOBS_MAX bins with
+    # one bin per filter so that map loop has no empty pad bins.
+    ivar_filter = map_bin_dict['ivar_filter']
+    if ivar_filter >= 0 :
+        nfilt = len(ifiltobs_list);  valmin = -0.5;  valmax = nfilt - 0.5
+        map_bin_dict['nbin_list'][ivar_filter]     = nfilt
+        map_bin_dict['valmin_list'][ivar_filter]   = valmin
+        map_bin_dict['valmax_list'][ivar_filter]   = valmax
+        map_bin_dict['bin_edge_list'][ivar_filter] = \
+            np.linspace(valmin, valmax, nfilt+1)
+        set_map_bin_indices(map_bin_dict)
+        print(f"       --> {nfilt} {COLNAME_IFILTOBS} map bins")
+
     return
     # end get_filter_list
 
 
-def apply_field(row,FIELD_LISTS):
+def apply_field(df,input_yaml):
 
-    # return IFIELD index for this row.
-    # Input FIELD_LISTS is a list of lists; e..g,
+    # return IFIELD index for each row of df, using one vectorized
+    # lookup of FIELD in FIELD_GROUP_LOOKUP = {FIELD: IFIELD} dictionary
+    # prepared in read_input from FIELD_GROUP_LISTS; e..g,
     # [ ['X3','C3'] , ['S1', 'S2', 'X1', 'X2'] ]
 
-    FIELD = row['FIELD']
-    ifield = 0
-    for field_list in FIELD_LISTS:
-        if FIELD in field_list: return ifield
-        ifield += 1
+    FIELD_LISTS        = input_yaml['FIELD_GROUP_LISTS']
+    FIELD_GROUP_LOOKUP = input_yaml['FIELD_GROUP_LOOKUP']
 
-    # if we get here, abort
-    sys.exit(f"\n ERROR: FIELD={FIELD} is not in \n\t {FIELD_LISTS}. " \
-             f"\n\t See FIELDS arg in input file.")
+    ifield = df[COLNAME_FIELD].map(FIELD_GROUP_LOOKUP)
 
-    return ifield
-    # end apply_field
+    # abort if any FIELD is not in FIELD_LISTS
+    unknown = ifield.isna().to_numpy()
+    if unknown.any():
+        FIELD = df[COLNAME_FIELD].to_numpy()[unknown][0]
+        sys.exit(f"\n ERROR: FIELD={FIELD} is not in \n\t {FIELD_LISTS}. " \
+                 f"\n\t See FIELDS arg in input file.")
 
-def apply_id_1d(row, map_bin_dict):
-
-    # return 1D index for this row.
-    
-    id_1d          = map_bin_dict['id_1d']
-    NDIM           = map_bin_dict['NDIM']
-    varname_list   = map_bin_dict['varname_list']
-    nbin_list      = map_bin_dict['nbin_list']
-    indexing_array = map_bin_dict['indexing_array']
-    ib_list       = []
-
-    for varname, nbin in zip(varname_list, nbin_list) : 
-        ivarname = f"i_{varname}" 
-        # xxx ib       = getbin_varname(row[ivarname], nbin)
-        ib       = row[ivarname]
-        ib_list.append(ib)
-
-    # - - - 
-    # beware: this NDIM logic is goofy & fragile :(
-
-    SMART_WAY = False
-
-    if SMART_WAY:
-        # couldn't get this to work; need somebody even smarter ??
-        id_1d = indexing_array[np.ix_([[ib_list[i]] for i in ib_list])]
-    else:
-        # dumb way with NDIM if-block
-        if NDIM == 1:
-            id_1d  = indexing_array[ib_list[0]]
-        elif NDIM == 2 :
-            id_1d  = indexing_array[ib_list[0],ib_list[1]]
-        elif NDIM == 3 :
-            id_1d  = indexing_array[ib_list[0],ib_list[1],ib_list[2]]
-        elif NDIM == 4 :
-            id_1d = indexing_array[ib_list[0],ib_list[1],ib_list[2],ib_list[3]]
-    return id_1d
-    # end apply_id_1d
-
-def getbin_varname(ibin_raw, nbin):
-    # xxx obsolete xxxx
-    ibin = ibin_raw
-    if ibin < 0: ibin = 0
-    if ibin >= nbin : ibin = nbin-1
-    return ibin
+    return ifield.to_numpy(dtype=get_index_dtype(len(FIELD_LISTS)))
+    # end apply_field
 
 # =====================================
 #
@@ -1129,10 +1537,15 @@ if __name__ == "__main__":
     simgen(ISTAGE,config)
 
     # run snana on fakes and sim; create OUTLIER table with nsig>=0
-    # to catch all flux observations
+    # to catch all flux observations. FAKE and SIM jobs are independent,
+    # so run them in parallel if nproc > 1.
     ISTAGE += 1
-    config.flux_table_fake = make_outlier_table(ISTAGE,config,STRING_FAKE)
-    config.flux_table_sim  = make_outlier_table(ISTAGE,config,STRING_SIM)
+    what_list = [ STRING_FAKE, STRING_SIM ]
+    nproc     = max(1, min(config.args.nproc, len(what_list)))
+    with ThreadPoolExecutor(max_workers=nproc) as executor:
+        table_list = list(executor.map(
+            lambda what: make_outlier_table(ISTAGE,config,what), what_list))
+    config.flux_table_fake, config.flux_table_sim = table_list
 
     ISTAGE += 1
     parse_map_bins(config)